@@ -1,35 +1,117 @@
 import argparse
-import json
+import asyncio
+import atexit
+import functools
+import importlib
 import logging
+import logging.handlers
 import os
 import re
-import subprocess
-import time
+import sys
+import threading
 import traceback
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson as json
+except ImportError:
+    import json
+
+USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36"
+)
+HTTP_TIMEOUT = (5, 30)
+HTML_CHUNK_SIZE = 4096
+LOG_BUFFER_CAPACITY = 256
+MAX_PAGES = 1000
+PAGE_SIZE = 100
+PAGE_BATCH_SIZE = 8
+JSONP_CALLBACK = "lanmu_0"
+JSONP_PREFIX = f"{JSONP_CALLBACK}("
+JSONP_SUFFIX = ");"
+
+TITLE_RE = re.compile(r"<title>(.*)</title>")
+TOPC_RE = re.compile(r"TOPC[0-9]+")
+# [\W_] is exactly the set of characters for which str.isalnum() is False
+UNSAFE_CHAR_RE = re.compile(r"[\W_]")
+
+# populated by load_yt_dlp() once the patched checkout's location is known
+yt_dlp = None
+YDL = None
+YDL_LOCK = threading.Lock()
+YDL_LOCAL = threading.local()
+
+
+def make_session():
+    session = requests.Session()
+    # the session only serves the program page and the video-list paging,
+    # yt-dlp downloads fragments over its own connections
+    adapter = HTTPAdapter(
+        pool_connections=8,
+        pool_maxsize=PAGE_BATCH_SIZE,
+        max_retries=Retry(total=3, backoff_factor=0.3),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({"User-Agent": USER_AGENT})
+    return session
+
+
+SESSION = make_session()
 
 
 def setup_logging(debug=False):
+    # buffer file records, errors still hit the disk right away since
+    # download_video may os._exit() straight after logging one
+    file_target = logging.FileHandler("app.log")
+    file_handler = logging.handlers.MemoryHandler(
+        LOG_BUFFER_CAPACITY, flushLevel=logging.ERROR, target=file_target
+    )
+    atexit.register(file_handler.flush)
     logging.basicConfig(
         level=logging.DEBUG if debug else logging.INFO,
         format="%(asctime)s [%(levelname)s] %(message)s",
         datefmt="%H:%M:%S",
         handlers=[
-            logging.FileHandler("app.log"),
+            file_handler,
             logging.StreamHandler(),
         ],
     )
+    # basicConfig only formats the handlers it is given, not the buffer target
+    file_target.setFormatter(file_handler.formatter)
+
+
+def has_program_info(html):
+    topc_match = TOPC_RE.search(html)
+    # a TOPC id touching the end of the buffer may still be cut mid-digits
+    return (
+        TITLE_RE.search(html) is not None
+        and topc_match is not None
+        and topc_match.end() < len(html)
+    )
 
 
 def request_html(link):
     try:
-        response = requests.get(link)
-        response.raise_for_status()  # Check for HTTP errors
-        response.encoding = "utf-8"  # Ensure the encoding is set to utf-8
-        return response.text
+        with SESSION.get(link, stream=True, timeout=HTTP_TIMEOUT) as response:
+            response.raise_for_status()  # Check for HTTP errors
+            response.encoding = "utf-8"  # Ensure the encoding is set to utf-8
+            # title and TOPC live in <head>, stop reading once both are seen
+            html = ""
+            for chunk in response.iter_content(
+                HTML_CHUNK_SIZE, decode_unicode=True
+            ):
+                html += chunk
+                if has_program_info(html):
+                    break
+            return html
     except requests.exceptions.RequestException as e:
         logging.error(
             f"Can't get the requested link, status code {
@@ -39,71 +121,87 @@ def request_html(link):
         exit(1)
 
 
-def get_program_title(program_link):
-    html = request_html(program_link)
-    pattern = r"<title>(.*)</title>"
-    match = re.search(pattern, html)
+def get_program_title(html):
+    match = TITLE_RE.search(html)
     if not match:
         logging.warning("Can't locate program title.")
         return ""
     return match.group(1)
 
 
-def get_topc(program_link):
-    html = request_html(program_link)
-    pattern = r".*(TOPC[0-9]+).*"
-    match = re.search(pattern, html)
+def get_topc(html):
+    match = TOPC_RE.search(html)
     if not match:
         logging.error("Can't locate program id.")
         exit(1)
-    return match.group(1)
+    return match.group(0)
 
 
 def get_video_list(topc, limit=0):
     def request_url_f(topc, page):
         return (
             f"https://api.cntv.cn/NewVideo/getVideoListByColumn?id={topc}"
-            f"&n=100&sort=desc&p={
-                page}&d=&mode=0&serviceId=tvcctv&callback=lanmu_0"
+            f"&n={PAGE_SIZE}&sort=desc&p={
+                page}&d=&mode=0&serviceId=tvcctv&callback={JSONP_CALLBACK}"
         )
 
-    def jsonify(response_text):
-        return json.loads(response_text.lstrip("lanmu_0(").rstrip(");"))
-
-    def parse(entry):
-        return (entry["url"], entry["title"], entry["time"])
+    def jsonify(response_content):
+        # lstrip()/rstrip() take a character set, so slice the JSONP wrapper off
+        return json.loads(response_content[len(JSONP_PREFIX) : -len(JSONP_SUFFIX)])
 
-    result_list = []
-    for pg in range(0, 1000):
-        response = requests.get(request_url_f(topc, pg))
-        response_json = jsonify(response.text)
-        video_list = response_json["data"]["list"]
-        result_list += video_list
-        logging.info(f"Fetched {len(video_list)} video info from page {pg}")
-        if not video_list or (limit and len(result_list) > limit):
-            break
+    def fetch_page(pg):
+        response = SESSION.get(request_url_f(topc, pg), timeout=HTTP_TIMEOUT)
+        # both json backends take raw bytes, skip decoding the body to str
+        return jsonify(response.content)["data"]["list"]
 
+    # no point fetching more pages per batch than the limit can use
+    batch_size = PAGE_BATCH_SIZE
     if limit:
-        result_list = result_list[:limit]
-
-    return [parse(e) for e in result_list]
+        batch_size = min(batch_size, -(-limit // PAGE_SIZE))
 
+    result_list = []
+    with ThreadPoolExecutor(max_workers=batch_size) as executor:
+        for batch_start in range(0, MAX_PAGES, batch_size):
+            pages = range(batch_start, min(batch_start + batch_size, MAX_PAGES))
+            # map() yields results in submission order, so pages stay sorted
+            for pg, video_list in zip(pages, executor.map(fetch_page, pages)):
+                logging.info(f"Fetched {len(video_list)} video info from page {pg}")
+                if not video_list:
+                    return result_list
+                for entry in video_list:
+                    result_list.append((entry["url"], entry["title"], entry["time"]))
+                    if limit and len(result_list) >= limit:
+                        return result_list
+
+    return result_list
+
+
+def load_yt_dlp(yt_dlp_dir):
+    global yt_dlp
+    # yt_dlp_dir points at the package itself, so import it from its parent
+    sys.path.insert(0, str(Path(yt_dlp_dir).resolve().parent))
+    try:
+        yt_dlp = importlib.import_module("yt_dlp")
+    except ImportError:
+        logging.error(f"Can't import yt-dlp from {yt_dlp_dir}.")
+        logging.debug(traceback.format_exc())
+        exit(1)
+    if not hasattr(yt_dlp, "YoutubeDL"):
+        logging.error(f"{yt_dlp_dir} doesn't look like a yt-dlp checkout.")
+        exit(1)
 
-def check_resolution(link, yt_dlp_dir):
-    download_command = ["python3", str(Path(yt_dlp_dir) / "__main__.py"), "-F", link]
 
+def check_resolution(link):
+    global YDL
     try:
-        logging.debug(" ".join(download_command))
-        result = subprocess.run(
-            download_command, check=True, capture_output=True, text=True
-        )
-        logging.debug(f"Command output: {result.stdout}")
-        logging.debug(f"Command error output: {result.stderr}")
-    except subprocess.CalledProcessError as e:
-        logging.error("Running command returned non-zero exit code.")
-        logging.debug(f"Command output: --- \n {e.stdout}")
-        logging.debug(f"Command error output: --- \n {e.stderr}")
-        if "403" in str(e.stderr):
+        # YoutubeDL isn't fully thread-safe, share one instance under a lock
+        with YDL_LOCK:
+            if YDL is None:
+                YDL = yt_dlp.YoutubeDL({"quiet": True, "skip_download": True})
+            info = YDL.extract_info(link, download=False)
+    except yt_dlp.utils.DownloadError as e:
+        logging.error("yt-dlp failed to list the available formats.")
+        if "403" in str(e):
             logging.error("403 Detected, make sure that you proxy hls.cntv.cdn20.com.")
             logging.error("Refer to https://github.com/yt-dlp/yt-dlp/issues/10082")
         logging.debug(traceback.format_exc())
@@ -113,82 +211,137 @@ def check_resolution(link, yt_dlp_dir):
         logging.error(traceback.format_exc())
         exit(1)
 
+    format_ids = {f["format_id"] for f in info.get("formats") or []}
+    logging.debug(f"Available formats: {sorted(format_ids)}")
+
     res_tiers = []
     for i in range(100):
-        if f"hls-{i}" not in result.stdout:
+        if f"hls-{i}" not in format_ids:
             break
         res_tiers.append(f"hls-{i}")
 
     return res_tiers
 
 
-def check_program(yt_dlp_dir):
+def check_program():
     TEST_LINK = "https://tv.cctv.com/2024/06/14/VIDEAO2aMkgnG6AouAOuSKs1240614.shtml"
-    res = check_resolution(TEST_LINK, yt_dlp_dir)
+    res = check_resolution(TEST_LINK)
     if len(res) != 4:
         logging.error("yt-dlp is not configured correctly")
         exit(-1)
 
 
+@functools.lru_cache(maxsize=4096)
 def safe_title_f(video_title):
-    return "".join(c if c.isalnum() else "_" for c in video_title)
+    return UNSAFE_CHAR_RE.sub("_", video_title)
 
 
-def output_path_f(output_path_str, video_title, res, date):
-    output_path = Path(output_path_str)
-    safe_title = safe_title_f(video_title)
-    return str(output_path / f"{date}_{safe_title}_{res}.mp4")
+def video_key_f(video_title, date):
+    return f"{date}_{safe_title_f(video_title)}"
 
 
-def do_video_exist(output_path_str, video_title):
-    safe_video_title = safe_title_f(video_title)
-    for filename in os.listdir(output_path_str):
-        if safe_video_title in filename and filename.endswith(".mp4"):
-            return True
-    return False
+def output_path_f(output_path_str, video_title, res, date):
+    output_path = Path(output_path_str)
+    return str(output_path / f"{video_key_f(video_title, date)}_{res}.mp4")
+
+
+def list_existing_videos(output_path_str):
+    existing_files = defaultdict(list)
+    with os.scandir(output_path_str) as it:
+        for entry in it:
+            if entry.name.endswith(".mp4"):
+                # strip the "_{res}.mp4" suffix to get back video_key_f()
+                existing_files[entry.name.rsplit("_", 1)[0]].append(entry.name)
+    return existing_files
+
+
+def do_video_exist(existing_files, video_title, date):
+    return video_key_f(video_title, date) in existing_files
+
+
+def thread_ydl(res, fragment_thread):
+    # building a YoutubeDL sets up every extractor, so keep one per thread.
+    # The format selector is compiled in __init__, rebuild if res changes
+    key = (res, fragment_thread)
+    if getattr(YDL_LOCAL, "key", None) != key:
+        YDL_LOCAL.ydl = yt_dlp.YoutubeDL(
+            {
+                "format": res,
+                "concurrent_fragment_downloads": fragment_thread,
+                # the CLI defaults these to 10, the API leaves them at 0
+                "retries": 10,
+                "fragment_retries": 10,
+                "quiet": True,
+                "noprogress": True,
+            }
+        )
+        YDL_LOCAL.key = key
+    return YDL_LOCAL.ydl
 
 
-def download_video(
-    video_info, output_dir, index, total_videos, fragment_thread, yt_dlp_dir, res
-):
+def download_video(video_info, output_dir, index, total_videos, fragment_thread, res):
     link, title, date = video_info
-    if do_video_exist(output_dir, title):
-        logging.info(f"Video {title} exists, skipping.")
-        return
-
-    # res = check_resolution(link, yt_dlp_dir)[-1]
-    output_path = output_path_f(output_dir, title, res, safe_title_f(date))
-    download_command = [
-        "python3",
-        str(Path(yt_dlp_dir) / "__main__.py"),
-        "-f",
-        res,
-        link,
-        "-N",
-        str(fragment_thread),
-        "-o",
-        str(output_path),
-    ]
+    date = safe_title_f(date)
+
+    # res = check_resolution(link)[-1]
+    output_path = output_path_f(output_dir, title, res, date)
+    ydl = thread_ydl(res, fragment_thread)
+    ydl.params["outtmpl"] = {"default": output_path}
     logging.info(f"Start downloading {title}")
-    logging.debug(" ".join(download_command))
+    logging.debug(f"yt-dlp output template: {output_path}")
 
+    # download() blocks until the file is written, no need to poll for it
     try:
-        subprocess.run(
-            download_command,
-            check=True,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.STDOUT,
-        )
-    except subprocess.CalledProcessError as e:
-        logging.error(
-            f"Command '{e.cmd}' returned non-zero exit status {e.returncode}."
-        )
-        os._exit(e.returncode)
+        ydl.download([link])
+    except yt_dlp.utils.DownloadError as e:
+        logging.error(f"yt-dlp failed to download {link}: {e}")
+        os._exit(1)
+    if not Path(output_path).is_file():
+        logging.error(f"yt-dlp finished but {output_path} is missing.")
+        os._exit(1)
+    logging.info(f"Downloaded complete {index + 1} / {total_videos}: {title}")
 
-    while not Path(output_path).exists():
-        time.sleep(1)
 
-    logging.info(f"Downloaded complete {index + 1} / {total_videos}: {title}")
+async def download_all(
+    video_list, output_dir, download_thread, fragment_thread, res, existing_files
+):
+    # to_thread() runs on the default executor, size it to the download limit
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=download_thread)
+    )
+    semaphore = asyncio.Semaphore(download_thread)
+    total_videos = len(video_list)
+
+    async def download_one(index, video_info):
+        # resuming a batch is mostly skips, settle those without a worker thread
+        _, title, date = video_info
+        date = safe_title_f(date)
+        if do_video_exist(existing_files, title, date):
+            logging.info(f"Video {title} exists, skipping.")
+            return
+        # claim the file now so a repeated entry later in the list is skipped;
+        # this runs on the event loop thread, so no lock is needed
+        output_name = Path(output_path_f(output_dir, title, res, date)).name
+        existing_files[video_key_f(title, date)].append(output_name)
+
+        async with semaphore:
+            try:
+                await asyncio.to_thread(
+                    download_video,
+                    video_info,
+                    output_dir,
+                    index,
+                    total_videos,
+                    fragment_thread,
+                    res,
+                )
+            except Exception as e:
+                logging.error(f"Error downloading video {video_info[1]}: {e}")
+
+    await asyncio.gather(
+        *(download_one(index, info) for index, info in enumerate(video_list)),
+        return_exceptions=True,
+    )
 
 
 def main():
@@ -242,14 +395,12 @@ def main():
 
     parser.add_argument(
         "--skip_check",
-        type=bool,
-        default=False,
+        action="store_true",
         help="Skip checking if yt-dlp is patched",
     )
     parser.add_argument(
         "--debug",
-        type=bool,
-        default=False,
+        action="store_true",
         help="Enable debug logging",
     )
     args = parser.parse_args()
@@ -266,46 +417,39 @@ def main():
 
     setup_logging(debug)
 
-    if not skip_check:
-        logging.info("Checking if yt_dlp patched...")
-        check_program(yt_dlp_dir)
-        logging.info("Checks passed.")
-
-    topc = get_topc(program_url)
-    program_title = get_program_title(program_url)
-    logging.info(f"Downloading video list for program {program_title}")
-    logging.debug(f"Program TOPC: {topc}")
-    video_list = get_video_list(topc, limit)
-    logging.info(
-        f"Found {len(video_list)} videos, start downloading with {
-            download_thread} threads after 3 seconds"
-    )
-    time.sleep(3)
+    load_yt_dlp(yt_dlp_dir)
 
-    Path(output_dir).mkdir(exist_ok=True)
-    total_videos = len(video_list)
+    try:
+        if not skip_check:
+            logging.info("Checking if yt_dlp patched...")
+            check_program()
+            logging.info("Checks passed.")
+
+        program_html = request_html(program_url)
+        topc = get_topc(program_html)
+        program_title = get_program_title(program_html)
+        logging.info(f"Downloading video list for program {program_title}")
+        logging.debug(f"Program TOPC: {topc}")
+        video_list = get_video_list(topc, limit)
+        logging.info(
+            f"Found {len(video_list)} videos, start downloading with {
+                download_thread} threads"
+        )
 
-    with ThreadPoolExecutor(max_workers=download_thread) as executor:
-        future_to_video = {
-            executor.submit(
-                download_video,
-                video_info,
+        Path(output_dir).mkdir(exist_ok=True)
+        existing_files = list_existing_videos(output_dir)
+        asyncio.run(
+            download_all(
+                video_list,
                 output_dir,
-                index,
-                total_videos,
+                download_thread,
                 fragment_thread,
-                yt_dlp_dir,
                 res,
-            ): video_info
-            for index, video_info in enumerate(video_list)
-        }
-
-        for future in as_completed(future_to_video):
-            video_info = future_to_video[future]
-            try:
-                future.result()
-            except Exception as e:
-                logging.error(f"Error downloading video {video_info[1]}: {e}")
+                existing_files,
+            )
+        )
+    finally:
+        SESSION.close()
 
 
 if __name__ == "__main__":